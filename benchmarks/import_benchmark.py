@@ -0,0 +1,47 @@
+"""
+Measures the import time of each module from ``src`` in a fresh interpreter
+(as it happens in every spawned pool worker or CLI invocation): prints the best
+of ``--repeat`` runs and the time above the import of ``numpy`` and ``pandas``.
+
+    python benchmarks/import_benchmark.py --repeat 5
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+MODULES = ['preprocessing_utils', 'extraction_utils', 'selection_utils', 'storage_utils']
+
+
+def import_time(statement, repeat):
+    """
+    Returns the best time of running ``statement`` in a new interpreter.
+
+    :param statement: str: python code to run
+    :param repeat: int: number of runs
+    :return: float: the best time (s)
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], cwd=SRC, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = import_time('import numpy, pandas', args.repeat)
+    print(f'{"numpy + pandas":<22}{baseline:>8.2f} s')
+    for module in MODULES:
+        t = import_time(f'import {module}', args.repeat)
+        print(f'{module:<22}{t:>8.2f} s  ({t - baseline:+.2f} s)')
+
+
+if __name__ == '__main__':
+    main()
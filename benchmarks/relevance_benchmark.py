@@ -0,0 +1,93 @@
+"""
+Compares ``get_stats`` in exact and fast modes on a synthetic wide feature set:
+prints the running time of both modes and the agreement of the relevance tables.
+Before that, checks the fast mode on the small tables where it used to fail.
+
+    python benchmarks/relevance_benchmark.py --n_features 50000
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import selection_utils
+
+
+def make_blocks(n_blocks, n_rows, n_features, random_state=0):
+    """
+    Creates blocks with a real target and features of different kinds:
+    informative ones (with different strength of dependence), noise, binary and constant ones.
+    """
+    rng = np.random.default_rng(random_state)
+    strength = np.zeros(n_features)
+    n_informative = n_features // 10
+    strength[:n_informative] = rng.uniform(0., .2, n_informative)
+
+    blocks = []
+    for _ in range(n_blocks):
+        target = rng.standard_normal(n_rows)
+        values = rng.standard_normal((n_rows, n_features)) + np.outer(target, strength)
+        values[:, -n_features // 20:] = values[:, -n_features // 20:] > 0
+        values[:, -n_features // 100:] = 1.
+        block = pd.DataFrame(values, columns=[f'feature_{i}' for i in range(n_features)])
+        block['target'] = target
+        blocks.append(block)
+    return blocks
+
+
+def check_fast_mode():
+    """
+    Checks the fast mode on the edge cases: only constant and real features are tested exactly
+    (``tsfresh`` returns ``p_value`` of object dtype then) and a feature with a missing value
+    (it must be rejected as in the exact mode).
+    """
+    blocks = make_blocks(3, 300, 200)
+    table = selection_utils.get_stats(blocks, mode='fast')
+    assert table['p_value'].dtype == np.float64
+    assert set(table.loc[table['exact'], 'type']) == {'constant', 'real'}
+
+    blocks[1].iloc[5, 0] = np.nan
+    for mode in ['exact', 'fast']:
+        try:
+            selection_utils.get_stats(blocks, mode=mode)
+        except ValueError:
+            continue
+        raise AssertionError(f'{mode} mode accepted a feature with NaN')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n_features', type=int, default=50000)
+    parser.add_argument('--n_blocks', type=int, default=5)
+    parser.add_argument('--n_rows', type=int, default=4000)
+    parser.add_argument('--sample_size', type=int, default=None)
+    parser.add_argument('--n_jobs', type=int, default=1)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    check_fast_mode()
+
+    blocks = make_blocks(args.n_blocks, args.n_rows, args.n_features)
+
+    start = time.perf_counter()
+    exact_table = selection_utils.get_stats(blocks, n_jobs=args.n_jobs, mode='exact')
+    exact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fast_table = selection_utils.get_stats(blocks, n_jobs=args.n_jobs, mode='fast',
+                                           sample_size=args.sample_size)
+    fast_time = time.perf_counter() - start
+
+    print(f'features: {args.n_features}, rows: {args.n_blocks * args.n_rows}, sample: {args.sample_size}')
+    print(f'exact mode: {exact_time:.1f} s')
+    print(f'fast mode:  {fast_time:.1f} s (speedup x{exact_time / fast_time:.1f})')
+    for k, v in selection_utils.relevance_agreement(exact_table, fast_table).items():
+        print(f'{k}: {v:.4f}')
+
+
+if __name__ == '__main__':
+    main()
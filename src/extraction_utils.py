@@ -1,8 +1,9 @@
+import numpy as np
 import pandas as pd
-from tsfresh import extract_features
-from tsfresh.feature_extraction import EfficientFCParameters
-from tsfresh.utilities.dataframe_functions import roll_time_series, impute
-from typing import Dict, Optional, List, Tuple
+from storage_utils import SeriesStore
+from typing import Dict, Optional, List, Tuple, Union
+
+# ``tsfresh`` takes seconds to import, so it is imported inside the functions that use it
 
 
 def timestamp_to_features(t):
@@ -17,6 +18,65 @@ def timestamp_to_features(t):
     return t.hour, t.minute, t.second, t.microsecond//1000
 
 
+def store_valid_positions(store, target_col, lags):
+    """
+    Returns the positions of the ``store`` rows which remain after creating lag features
+    and the target column and removing the missing values, i.e. the rows that
+    ``bcv_extract_features`` would keep for the same table in memory.
+
+    Only the precomputed index of valid rows and the ``target_col`` column are read,
+    the table itself is not copied. Still, it is one O(n) pass over the target column per
+    call: which rows have lags and the target depends on ``target_col`` and ``lags``, so it
+    can not be precomputed when the store is built. Afterwards the blocks are read by position.
+
+    :param store: SeriesStore: store with the quantized table
+    :param target_col: str: the name of the column with the target variable
+    :param lags: List[int]: numbers for which lag features are created
+    :return: np.ndarray: positions of the rows in the store
+    """
+    positions = store.valid_positions()
+    n = len(store)
+
+    # rows with known target value, padded so that the lags and the next row never leave the array
+    max_lag = max(lags)
+    known = np.zeros(n + max_lag + 1, dtype=bool)
+    known[max_lag:max_lag + n] = ~np.isnan(store.column(target_col))
+
+    # the target is a change to the next row, so the last row of the store has no target
+    keep = known[positions + max_lag + 1]
+    for lag in lags:
+        keep &= known[positions + max_lag - lag]
+
+    return positions[keep]
+
+
+def store_block(store, positions, target_col, lags):
+    """
+    Reads the rows with the given positions from the ``store`` and adds the same columns
+    that ``bcv_extract_features`` adds to the table in memory: lag features, the target
+    and the time features.
+
+    :param store: SeriesStore: store with the quantized table
+    :param positions: np.ndarray: positions of the rows in the store (see ``store_valid_positions``)
+    :param target_col: str: the name of the column with the target variable
+    :param lags: List[int]: numbers for which lag features are created
+    :return: pd.DataFrame: block of the table with ``event_time`` column
+    """
+    values = store.column(target_col)
+    block = store.frame(positions)
+
+    for lag in lags:
+        block[f'price_lag{lag}'] = values[positions - lag]
+
+    block['target'] = 100 * (values[positions + 1] - values[positions]) / values[positions]
+
+    # the same dtype as the ``timestamp_to_features`` values get in the table in memory
+    event_time = block['event_time'].dt
+    block['hour'], block['min'] = event_time.hour.astype(np.int64), event_time.minute.astype(np.int64)
+    block['sec'], block['ms'] = event_time.second.astype(np.int64), (event_time.microsecond // 1000).astype(np.int64)
+    return block
+
+
 def bcv_extract_features(
         df,
         n_blocks,
@@ -27,6 +87,7 @@ def bcv_extract_features(
         lags = None,
         mode='default',
         fc_parameters=None,
+        block_ids=None,
 ):
     """
     Implement the process of block cross validation of time series with
@@ -55,8 +116,11 @@ def bcv_extract_features(
     - the process of evaluating the features itself is parallel in any case, the only difference in mode is how the
       windows is formed;
 
-    :param df: pd.DataFrame: table with data for which it is necessary to carry out block cross-validation with counting
-              window features
+    - if ``df`` is a ``SeriesStore``, only the rows of the current block are read from disk, instead of copying the whole
+      table;
+
+    :param df: Union[pd.DataFrame, SeriesStore]: table with data for which it is necessary to carry out block
+              cross-validation with counting window features
 
     :param n_blocks: int: number of blocks for block cross validation
 
@@ -68,28 +132,38 @@ def bcv_extract_features(
     :param mode: str: windowing mode for feature extract
     :param fc_parameters: Optional[Dict[str, Optional[List[str]]]]: a dictionary containing information about which window functions should be calculated
      and with  what parameters
-    :return: List[pd.DataFrame]: list of ``n_tests`` dataframes of ``n_windows`` size with the addition of new features
-     (window functions, lags, 'target' column)
+    :param block_ids: Optional[List[int]]: numbers of the blocks to be calculated (``0`` is the earliest block),
+     all the blocks are calculated if None
+    :return: List[pd.DataFrame]: list of ``n_tests`` dataframes (or ``len(block_ids)`` dataframes) of ``n_windows``
+     size with the addition of new features (window functions, lags, 'target' column)
     """
 
     assert mode == 'default' or mode == 'parallel', \
         f'mode must be "default" or "parallel", not {mode}!'
 
+    from tsfresh import extract_features
+    from tsfresh.utilities.dataframe_functions import roll_time_series, impute
+
     if lags is None:
         lags = [1]
-        
-    for lag in lags:
-        df[f'price_lag{lag}'] = df[target_col].shift(lag)
 
-    df['target'] = 100 * (df[target_col].shift(-1) -
-                          df[target_col]) / df[target_col]
-
-    if 'event_time' not in df.columns:
-        df = df.dropna().reset_index()
+    from_store = isinstance(df, SeriesStore)
+    if from_store:
+        positions = store_valid_positions(df, target_col, lags)
+        n = positions.shape[0]
     else:
-        df = df.dropna().reset_index(drop=True)
+        for lag in lags:
+            df[f'price_lag{lag}'] = df[target_col].shift(lag)
 
-    n = df.shape[0]
+        df['target'] = 100 * (df[target_col].shift(-1) -
+                              df[target_col]) / df[target_col]
+
+        if 'event_time' not in df.columns:
+            df = df.dropna().reset_index()
+        else:
+            df = df.dropna().reset_index(drop=True)
+
+        n = df.shape[0]
     fold_size = n // n_blocks
 
     assert fold_size >= window_size + n_windows - 1, f'the parameters n_tests, ' \
@@ -99,18 +173,24 @@ def bcv_extract_features(
 
     assert max(lags) <= fold_size, f'data leak, max(lags)={max(lags)} is too much'
 
-    df[['hour', 'min', 'sec', 'ms']] = [timestamp_to_features(date) for date in df.event_time]
+    if not from_store:
+        df[['hour', 'min', 'sec', 'ms']] = [timestamp_to_features(date) for date in df.event_time]
     blocks = []
 
     for i in range(n_blocks, 0, -1):
+        if block_ids is not None and n_blocks - i not in block_ids:
+            continue
 
         print(f'current block: {n_blocks - i + 1}/{n_blocks}')
         print('==' * int(20 * (n_blocks - i + 1) / n_blocks) +
               '--' * int(20 * ((i - 1) / n_blocks)))
 
         end_block = n - fold_size * (i - 1) - 1
-        block = df.loc[end_block - window_size + 1 - n_windows +
-                       1:end_block].reset_index(drop=True)
+        start_block = end_block - window_size + 1 - n_windows + 1
+        if from_store:
+            block = store_block(df, positions[start_block:end_block + 1], target_col, lags)
+        else:
+            block = df.loc[start_block:end_block].reset_index(drop=True)
 
         if mode == 'parallel':
             # take advantage of the parallel execution feature of tsfresh,
@@ -171,7 +251,10 @@ def window_featurize(df,
     of the window. To avoid this problem, it will process each
     window separately.
 
-    :param df: pd.DataFrame: table with data for which it is necessary to calculate
+    If ``df`` is a ``SeriesStore``, only the last valid rows needed for the windows
+    are read from disk.
+
+    :param df: Union[pd.DataFrame, SeriesStore]: table with data for which it is necessary to calculate
      window features
     :param target_col: str: the name of the column with the target variable
     :param n_windows: int: the number of windows for which it is necessary
@@ -183,8 +266,16 @@ def window_featurize(df,
     :return: pd.DataFrame: dataframe of ``num_windows`` rows with counted window functions
     """
 
+    from tsfresh import extract_features
+    from tsfresh.feature_extraction import EfficientFCParameters
+    from tsfresh.utilities.dataframe_functions import impute
+
     if fc_parameters is None:
         fc_parameters = EfficientFCParameters()
+    if isinstance(df, SeriesStore):
+        n_valid = df.n_valid
+        assert n_valid >= window_size + n_windows - 1, 'small df'
+        df = df.frame(df.valid_positions(n_valid - window_size - n_windows + 1, n_valid))
     if 'event_time' not in df.columns:
         df = df.dropna().reset_index()
     else:
@@ -0,0 +1,503 @@
+"""
+Batch run of the whole ts-is-fresh pipeline with checkpoints:
+
+    separate -> quantize -> extract -> select -> correlate -> cross-table extract -> cross-table select
+
+Every stage is split into tasks (per symbol and per block), the output of each task is saved
+to ``workdir``. A task is skipped if its parameters, its input files and the outputs of the tasks
+it depends on did not change since the last run, so a rerun after a failure or a parameter tweak
+recalculates only the invalidated part. Independent tasks are run in parallel. The tables
+that are split into blocks are saved as ``SeriesStore`` s, so each extraction task reads only its block.
+
+    python src/pipeline.py --raw data/raw/trades_v2_short.pkl \\
+        --target data/raw/chz_usdt_perp_midprice_v2_short.pkl \\
+        --target-name CHZ_USDT_PERP_MIDPRICE --symbols @symbols.txt --jobs 8
+"""
+import argparse
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import traceback
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import extraction_utils
+import preprocessing_utils
+import selection_utils
+import storage_utils
+
+# modules with the code of the tasks, a checkpoint is invalidated when the functions of these modules
+# called by its task are changed
+CODE_MODULES = [extraction_utils, preprocessing_utils, selection_utils, storage_utils]
+
+
+class Task:
+    """
+    A node of the pipeline DAG. The function ``func`` is called with ``params``, the outputs
+    of the tasks from ``deps`` and ``n_jobs``, its result is saved to ``{workdir}/{name}.pkl``.
+    """
+
+    def __init__(self, name, func, params=None, deps=None, files=None, writes_files=False):
+        """
+        :param name: str: unique name of the task, it is also the path of its checkpoint
+         (e.g. ``quantize/BTC_USDT_PERP``)
+        :param func: Callable: module level function (it is sent to the pool workers)
+        :param params: Optional[Dict[str, Any]]: arguments of ``func`` that affect the result
+        :param deps: Optional[Dict[str, Union[str, List[str]]]]: arguments of ``func`` that are the outputs of
+         other tasks (a name of the task or a list of names)
+        :param files: Optional[List[str]]: input files, the task is rerun if one of them is changed
+        :param writes_files: bool: the task writes files besides its checkpoint and returns a dictionary
+         ``{path: digest}`` of them, the task is rerun if one of them is removed
+        """
+        self.name = name
+        self.func = func
+        self.params = params or {}
+        self.deps = deps or {}
+        self.files = files or []
+        self.writes_files = writes_files
+
+    def dep_names(self):
+        """ names of all the tasks this task depends on """
+        names = []
+        for dep in self.deps.values():
+            names.extend([dep] if isinstance(dep, str) else dep)
+        return names
+
+
+def run_tasks(tasks, workdir, n_jobs=1, force=False):
+    """
+    Runs the tasks in the order of their dependencies. The tasks whose dependencies are ready
+    are run together: in parallel by ``n_jobs`` processes, or one by one if there is only one
+    such task (then the task itself can use ``n_jobs`` cores).
+
+    A task is skipped if its checkpoint was made with the same key, i.e. with the same
+    function (and source code of it and of the functions from ``CODE_MODULES`` it calls),
+    ``params``, input files and outputs of the dependencies. The dependencies
+    are compared by the digest of their outputs, so if a rerun task returns the same result,
+    the tasks after it are not rerun. A task that writes files besides its checkpoint
+    (``writes_files``) is rerun if one of them is removed.
+
+    :param tasks: List[Task]: tasks to run, they may depend on the tasks from the previous runs
+    :param workdir: str: the directory with checkpoints
+    :param n_jobs: int: number of processes
+    :param force: bool: rerun the tasks even if their checkpoints are up to date
+    """
+    pending = {task.name: task for task in tasks}
+
+    while pending:
+        ready = [task for task in pending.values()
+                 if all(name not in pending for name in task.dep_names())]
+        assert ready, f'cyclic dependencies between the tasks: {list(pending)}'
+
+        to_run = []
+        for task in ready:
+            del pending[task.name]
+            key = _task_key(task, workdir)
+            meta = _read_meta(workdir, task.name)
+            if not force and meta is not None and meta['key'] == key:
+                print(f'[skip] {task.name}', flush=True)
+            else:
+                to_run.append((task, key))
+
+        if len(to_run) > 1 and n_jobs > 1:
+            with Pool(min(n_jobs, len(to_run))) as pool:
+                errors = pool.starmap(_run_task, [(task, key, workdir, 1) for task, key in to_run])
+        else:
+            errors = [_run_task(task, key, workdir, n_jobs) for task, key in to_run]
+
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise RuntimeError('\n'.join(errors) + f'\n{len(errors)} task(s) failed, rerun to resume')
+
+
+def load_output(workdir, name):
+    """
+    Loads the saved output of the task.
+
+    :param workdir: str: the directory with checkpoints
+    :param name: str: the name of the task
+    :return: Any: the output of the task
+    """
+    with open(f'{workdir}/{name}.pkl', 'rb') as f:
+        return pickle.load(f)
+
+
+def _read_meta(workdir, name):
+    """
+    the key and the digest of the output of the task, None if there is no checkpoint
+    or one of the files written by the task is removed
+    """
+    path = f'{workdir}/{name}.json'
+    if not os.path.exists(path) or not os.path.exists(f'{workdir}/{name}.pkl'):
+        return None
+    with open(path) as f:
+        meta = json.load(f)
+    if not all(os.path.exists(file) for file in meta.get('files', [])):
+        return None
+    return meta
+
+
+def _task_key(task, workdir):
+    """ hash of everything that the output of the task depends on """
+    deps = {}
+    for arg, dep in task.deps.items():
+        names = [dep] if isinstance(dep, str) else dep
+        metas = [_read_meta(workdir, name) for name in names]
+        for name, meta in zip(names, metas):
+            assert meta is not None, f'task {task.name} depends on {name}, which has no checkpoint'
+        deps[arg] = [meta['digest'] for meta in metas]
+
+    files = [(path, os.path.getsize(path), os.path.getmtime(path)) for path in task.files]
+    payload = {
+        'func': task.func.__name__,
+        'code': _code_digest(task.func),
+        'params': task.params,
+        'deps': deps,
+        'files': files,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _code_digest(func):
+    """
+    sha256 of the source code of ``func`` and of all the functions and classes from this module and
+    ``CODE_MODULES`` that it calls (directly or through each other), so that an edit of an unrelated
+    function (or of a docstring elsewhere in the module) does not invalidate the checkpoint
+    """
+    modules = {module.__name__: module for module in CODE_MODULES + [inspect.getmodule(_code_digest)]}
+    sources = {}
+    stack = [func]
+    while stack:
+        obj = inspect.unwrap(stack.pop())
+        name = f'{obj.__module__}.{obj.__qualname__}'
+        if name in sources:
+            continue
+        sources[name] = inspect.getsource(obj)
+
+        if inspect.isclass(obj):
+            members = [getattr(m, '__func__', getattr(m, 'fget', m)) for m in vars(obj).values()]
+            stack.extend(m for m in members if inspect.isfunction(m))
+            continue
+
+        # the names used by the function and its nested functions: globals of its module and
+        # attributes of ``CODE_MODULES`` (e.g. ``selection_utils.get_stats``)
+        codes, names = [obj.__code__], set()
+        while codes:
+            code = codes.pop()
+            names.update(code.co_names)
+            codes.extend(const for const in code.co_consts if inspect.iscode(const))
+        scopes = [obj.__globals__] + [vars(modules[n]) for n in names if n in modules]
+        for scope in scopes:
+            for n in names:
+                value = inspect.unwrap(scope[n]) if callable(scope.get(n)) else None
+                if (inspect.isfunction(value) or inspect.isclass(value)) and value.__module__ in modules:
+                    stack.append(value)
+
+    return hashlib.sha256(json.dumps(sources, sort_keys=True).encode()).hexdigest()
+
+
+def _run_task(task, key, workdir, n_jobs):
+    """ runs the task and saves its output, returns the error message if it fails """
+    print(f'[run] {task.name}', flush=True)
+    try:
+        inputs = {}
+        for arg, dep in task.deps.items():
+            if isinstance(dep, str):
+                inputs[arg] = load_output(workdir, dep)
+            else:
+                inputs[arg] = [load_output(workdir, name) for name in dep]
+        result = task.func(**task.params, **inputs, n_jobs=n_jobs)
+    except Exception:
+        return f'[fail] {task.name}\n{traceback.format_exc()}'
+
+    path = f'{workdir}/{task.name}'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.pkl.tmp', 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    digest = _file_digest(f'{path}.pkl.tmp')
+
+    # the checkpoint is valid only when both files are replaced
+    if os.path.exists(f'{path}.json'):
+        os.remove(f'{path}.json')
+    os.replace(f'{path}.pkl.tmp', f'{path}.pkl')
+    with open(f'{path}.json.tmp', 'w') as f:
+        meta = {'key': key, 'digest': digest}
+        if task.writes_files:
+            meta['files'] = sorted(result)
+        json.dump(meta, f)
+    os.replace(f'{path}.json.tmp', f'{path}.json')
+    return None
+
+
+def _file_digest(path):
+    """ sha256 of the content of the file """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _separate(raw_path, sep_col, out_dir, n_jobs=1):
+    """ separates all the symbols of the raw table, returns the digests of their tables by their paths """
+    df = pd.read_pickle(raw_path)
+    names = list(df[sep_col].unique())
+    os.makedirs(out_dir, exist_ok=True)
+    preprocessing_utils.separate_and_save(df=df, names=names, sep_col=sep_col, path_to_save=out_dir)
+    return {f'{out_dir}/{name}.csv': _file_digest(f'{out_dir}/{name}.csv') for name in names}
+
+
+def _separated(digests, out_dir, name, n_jobs=1):
+    """ the digest of the separated table of one symbol, so that its tasks do not depend on the others """
+    path = f'{out_dir}/{name}.csv'
+    assert path in digests, f'there is no symbol {name} in the raw table'
+    return digests[path]
+
+
+def _quantize(path_from, name, freq, separated, n_jobs=1):
+    df = preprocessing_utils.load_tables(names=[name], path_from=path_from)[name]
+    return preprocessing_utils.quantize_table(df, freq=freq)
+
+
+def _quantize_target(target_path, target_name, freq, n_jobs=1):
+    return preprocessing_utils.quantize_target_table(pd.read_pickle(target_path), target_name, freq=freq)
+
+
+def _store(table, path, n_jobs=1):
+    """
+    saves the table as a ``SeriesStore`` (from scratch, the task is rerun only if the table is changed),
+    returns the digests of the store files by their paths
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    name = os.path.basename(path)
+    storage_utils.save_stores(df_dict={name: table}, names=[name], path_to=os.path.dirname(path))
+    files = [f'{path}/{file}' for file in ['meta.json', 'index.bin', 'values.bin', 'valid.bin']]
+    return {file: _file_digest(file) for file in files}
+
+
+def _extract_block(store_path, store, block_id, target_col, n_blocks, n_windows, window_size, lags, mode,
+                   selection=None, n_jobs=1):
+    """ the block is read from the store, so the task does not load and copy the whole table """
+    if selection is None:
+        from tsfresh.feature_extraction import EfficientFCParameters
+        fc_parameters = EfficientFCParameters()
+    else:
+        fc_parameters = selection['fc_parameters']
+
+    return extraction_utils.bcv_extract_features(df=storage_utils.SeriesStore(store_path),
+                                                 n_blocks=n_blocks,
+                                                 target_col=target_col,
+                                                 n_jobs=n_jobs,
+                                                 n_windows=n_windows,
+                                                 window_size=window_size,
+                                                 lags=lags,
+                                                 mode=mode,
+                                                 fc_parameters=fc_parameters,
+                                                 block_ids=[block_id])[0]
+
+
+def _select(blocks, target_col, test_size, relevance_mode, portion, n_jobs=1):
+    from tsfresh.feature_extraction.settings import from_columns
+
+    relevance_table = selection_utils.get_stats(blocks, n_jobs=n_jobs, mode=relevance_mode)
+    stats_features = sorted(selection_utils.stats_select_features(relevance_table))
+
+    train = [block[stats_features + ['target']][:-test_size] for block in blocks]
+    models = selection_utils.get_fitted_models(train, n_jobs)
+    importances = selection_utils.get_importance(models, train, mode='all')
+    features = [f for f, _ in selection_utils.importance_select_features(importances, portion)]
+
+    window_features = [f for f in features if f.startswith(f'{target_col}__')]
+    assert window_features, 'no window features were selected, the cross-table stage is impossible'
+    return {
+        'stats_features': stats_features,
+        'features': features,
+        'fc_parameters': from_columns(window_features)[target_col],
+    }
+
+
+def _correlation(table, target_table, n_jobs=1):
+    """ correlation of the price changes of the table and the target table """
+    x = 100 * (table['price_mean'].shift(-1) - table['price_mean']) / table['price_mean']
+    y = 100 * (target_table['price_mean'].shift(-1) - target_table['price_mean']) / target_table['price_mean']
+
+    x_diff = x - np.mean(x)
+    y_diff = y - np.mean(y)
+    return np.sum(x_diff * y_diff) / np.sqrt(np.sum(x_diff ** 2) * np.sum(y_diff ** 2))
+
+
+def _top_symbols(correlations, names, top_k, n_jobs=1):
+    return [name for _, name in sorted(zip(correlations, names))[-top_k:]]
+
+
+def _cross_table(table, target_table, tables, name, n_jobs=1):
+    """ ``table`` with ``(name)`` prefix in column names on the rows where all the tables are known """
+    index = pd.concat([target_table] + tables, axis=1).dropna().index
+    table = table.loc[index]
+    table.columns = [f'({name}) {col}' for col in table.columns]
+    return table
+
+
+def _cross_select(target_blocks, blocks, names, lags, test_size, portion, max_features, n_jobs=1):
+    n_blocks = len(target_blocks)
+    train = []
+    for i in range(n_blocks):
+        block_list = [target_blocks[i]]
+        for j, name in enumerate(names):
+            # remove common columns (time features) and data from the future (target col)
+            block = blocks[j * n_blocks + i].drop(['hour', 'min', 'sec', 'ms', 'target'], axis=1)
+            block = block.rename(columns={f'price_lag{lag}': f'({name}) price_mean_lag{lag}' for lag in lags})
+            block_list.append(block)
+        train.append(pd.concat(block_list, axis=1)[:-test_size])
+
+    models = selection_utils.get_fitted_models(train, n_jobs)
+    importances = selection_utils.get_importance(models, train, mode='all')
+    selected = selection_utils.importance_select_features(importances, portion)[:max_features]
+    return {'features': [f for f, _ in selected], 'importances': dict(importances)}
+
+
+def first_stage_tasks(args):
+    """
+    Tasks of the first stage: separation and quantization of the tables, extraction of the window
+    features of the target table, their selection and ranking of the symbols by correlation with the target.
+
+    :param args: argparse.Namespace: command line arguments
+    :return: List[Task]: tasks
+    """
+    separated_dir = f'{args.workdir}/separated'
+    tasks = [
+        Task('separate', _separate,
+             params={'raw_path': args.raw, 'sep_col': args.sep_col, 'out_dir': separated_dir},
+             files=[args.raw], writes_files=True),
+        Task(f'quantize/{args.target_name}', _quantize_target,
+             params={'target_path': args.target, 'target_name': args.target_name, 'freq': args.freq},
+             files=[args.target]),
+    ]
+    for name in args.symbols:
+        tasks.append(Task(f'separate/{name}', _separated,
+                          params={'out_dir': separated_dir, 'name': name},
+                          deps={'digests': 'separate'}))
+        tasks.append(Task(f'quantize/{name}', _quantize,
+                          params={'path_from': separated_dir, 'name': name, 'freq': args.freq},
+                          deps={'separated': f'separate/{name}'}))
+        tasks.append(Task(f'correlate/{name}', _correlation,
+                          deps={'table': f'quantize/{name}', 'target_table': f'quantize/{args.target_name}'}))
+    tasks.append(Task('correlate/top', _top_symbols,
+                      params={'names': args.symbols, 'top_k': args.top_k},
+                      deps={'correlations': [f'correlate/{name}' for name in args.symbols]}))
+
+    target_store = f'{args.workdir}/stores/{args.target_name}'
+    tasks.append(Task(f'store/{args.target_name}', _store,
+                      params={'path': target_store},
+                      deps={'table': f'quantize/{args.target_name}'},
+                      writes_files=True))
+    for i in range(args.n_blocks):
+        tasks.append(Task(f'extract/block_{i}', _extract_block,
+                          params={'store_path': target_store, 'block_id': i, 'target_col': 'price_mean',
+                                  'n_blocks': args.n_blocks, 'n_windows': args.n_windows,
+                                  'window_size': args.window_size, 'lags': args.lags, 'mode': args.extract_mode},
+                          deps={'store': f'store/{args.target_name}'}))
+    tasks.append(Task('select', _select,
+                      params={'target_col': 'price_mean', 'test_size': args.test_size,
+                              'relevance_mode': args.relevance_mode, 'portion': args.portion},
+                      deps={'blocks': [f'extract/block_{i}' for i in range(args.n_blocks)]}))
+    return tasks
+
+
+def cross_table_tasks(args, top_symbols):
+    """
+    Tasks of the second stage: extraction of the selected window features from the tables of
+    the most correlated symbols and selection of the features by importance.
+
+    :param args: argparse.Namespace: command line arguments
+    :param top_symbols: List[str]: the most correlated symbols
+    :return: List[Task]: tasks
+    """
+    names = list(top_symbols) + [args.target_name]
+    tasks = []
+    for name in names:
+        tasks.append(Task(f'cross/{name}/table', _cross_table,
+                          params={'name': name},
+                          deps={'table': f'quantize/{name}',
+                                'target_table': f'quantize/{args.target_name}',
+                                'tables': [f'quantize/{symbol}' for symbol in top_symbols]}))
+        store_path = f'{args.workdir}/stores/cross/{name}'
+        tasks.append(Task(f'cross/{name}/store', _store,
+                          params={'path': store_path},
+                          deps={'table': f'cross/{name}/table'},
+                          writes_files=True))
+        for i in range(args.cross_n_blocks):
+            tasks.append(Task(f'cross/{name}/block_{i}', _extract_block,
+                              params={'store_path': store_path, 'block_id': i, 'target_col': f'({name}) price_mean',
+                                      'n_blocks': args.cross_n_blocks, 'n_windows': args.cross_n_windows,
+                                      'window_size': args.window_size, 'lags': args.cross_lags,
+                                      'mode': args.extract_mode},
+                              deps={'store': f'cross/{name}/store', 'selection': 'select'}))
+
+    tasks.append(Task('cross/select', _cross_select,
+                      params={'names': list(top_symbols), 'lags': args.cross_lags,
+                              'test_size': args.cross_test_size, 'portion': args.portion,
+                              'max_features': args.max_features},
+                      deps={'target_blocks': [f'cross/{args.target_name}/block_{i}'
+                                              for i in range(args.cross_n_blocks)],
+                            'blocks': [f'cross/{name}/block_{i}' for name in top_symbols
+                                       for i in range(args.cross_n_blocks)]}))
+    return tasks
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, fromfile_prefix_chars='@',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--raw', required=True, help='pickle with the trades table')
+    parser.add_argument('--target', required=True, help='pickle with the target table')
+    parser.add_argument('--target-name', required=True, help='the name of the price column of the target table')
+    parser.add_argument('--symbols', required=True, nargs='+', help='symbols to use (or @file with them)')
+    parser.add_argument('--sep-col', default='symbol')
+    parser.add_argument('--workdir', default='data/pipeline', help='the directory with checkpoints')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes')
+    parser.add_argument('--force', action='store_true', help='ignore the checkpoints')
+    parser.add_argument('--freq', default='300ms')
+    parser.add_argument('--n-blocks', type=int, default=24)
+    parser.add_argument('--n-windows', type=int, default=1800)
+    parser.add_argument('--window-size', type=int, default=200)
+    parser.add_argument('--lags', type=int, nargs='+', default=list(range(1, 11)))
+    parser.add_argument('--extract-mode', default='parallel', choices=['default', 'parallel'])
+    parser.add_argument('--relevance-mode', default='exact', choices=['exact', 'fast'])
+    parser.add_argument('--test-size', type=int, default=10)
+    parser.add_argument('--portion', type=float, default=0.8)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--cross-n-blocks', type=int, default=5)
+    parser.add_argument('--cross-n-windows', type=int, default=1500)
+    parser.add_argument('--cross-lags', type=int, nargs='+', default=[1])
+    parser.add_argument('--cross-test-size', type=int, default=20)
+    parser.add_argument('--max-features', type=int, default=35)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    run_tasks(first_stage_tasks(args), args.workdir, n_jobs=args.jobs, force=args.force)
+    top_symbols = load_output(args.workdir, 'correlate/top')
+    run_tasks(cross_table_tasks(args, top_symbols), args.workdir, n_jobs=args.jobs, force=args.force)
+
+    result = {
+        'top_symbols': top_symbols,
+        'selected_features': load_output(args.workdir, 'select')['features'],
+        'cross_selected_features': load_output(args.workdir, 'cross/select')['features'],
+    }
+    with open(f'{args.workdir}/result.json', 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'the selected features are saved to {args.workdir}/result.json')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,32 @@
+import functools
 import numpy as np
 import pandas as pd
-import numba
 from typing import Dict, List
 
 
-@numba.jit(forceobj=True)
-def triple_dot(c1: np.ndarray, c2: np.ndarray, c3: np.ndarray) -> np.ndarray:
-    """ accelerated intermediate calculations in the table separating process """
+@functools.lru_cache(maxsize=None)
+def _jit(func):
+    """
+    Compiles ``func`` with ``numba`` on the first use. ``numba`` itself is imported here, so
+    importing this module stays fast, and the compiled code is cached on disk, so new
+    processes (e.g. pool workers) do not compile it again.
+    """
+    import numba
+    return numba.njit(cache=True)(func)
+
+
+def _triple_dot(c1, c2, c3):
     return c1 * c2 * c3
 
 
+def triple_dot(c1: np.ndarray, c2: np.ndarray, c3: np.ndarray) -> np.ndarray:
+    """
+    accelerated intermediate calculations in the table separating process,
+    the arrays must be numeric (e.g. ``float64``), object arrays are not supported
+    """
+    return _jit(_triple_dot)(c1, c2, c3)
+
+
 def separate_and_save(df, names, sep_col='symbol',
                       path_to_save='data/'):
     """
@@ -28,12 +45,13 @@ def separate_and_save(df, names, sep_col='symbol',
     for name in names:
         t = df_grouped.get_group(name)
         # accelerated intermediate calculations
-        t['money_buy'] = triple_dot(t['price'].to_numpy(),
-                                    t['quantity'].to_numpy(),
-                                    t['is_buy'].to_numpy())
-        t['money_sell'] = triple_dot(t['price'].to_numpy(),
-                                     t['quantity'].to_numpy(),
-                                     (1 - t['is_buy']).to_numpy())
+        # ``is_buy`` may be loaded as an object column, the compiled kernel needs numeric arrays
+        t['money_buy'] = triple_dot(t['price'].to_numpy(dtype=np.float64),
+                                    t['quantity'].to_numpy(dtype=np.float64),
+                                    t['is_buy'].to_numpy(dtype=np.float64))
+        t['money_sell'] = triple_dot(t['price'].to_numpy(dtype=np.float64),
+                                     t['quantity'].to_numpy(dtype=np.float64),
+                                     (1 - t['is_buy']).to_numpy(dtype=np.float64))
         t['is_not_buy'] = 1 - t['is_buy']
         t.to_csv(f'{path_to_save}/{name}.csv')
     return
@@ -97,3 +115,23 @@ def quantize_table(df, freq='300ms'):
         buy_count=('is_buy', np.sum),
         sell_count=('is_not_buy', np.sum),
     )
+
+
+def quantize_target_table(df, target_name, freq='300ms'):
+    """
+    Returns the target table quantized by ``freq``-sized windows. The target table has
+    a different scheme from the trades tables: its index is the time, and the only column
+    ``target_name`` is the price, so only the mean price is calculated inside each window.
+
+    :param df: pd.DataFrame: unprocessed target table
+    :param target_name: str: the name of the column with the price
+    :param freq: str: quantization window width
+    :return: pd.DataFrame: dataframe quantized by ``freq``-sized windows with ``price_mean`` column
+    """
+    df = df.copy()
+    df['event_time'] = pd.to_datetime(df.index)
+    df = df.set_index('event_time')
+
+    return df.groupby(pd.Grouper(freq=freq, origin='start_day')).agg(
+        price_mean=(target_name, np.mean),
+    )
@@ -1,11 +1,11 @@
+import numpy as np
 import pandas as pd
 from typing import Dict, List, Tuple
 from collections import defaultdict
 import re
-import shap
-import xgboost
-from xgboost import XGBRegressor
-from tsfresh.feature_selection.relevance import calculate_relevance_table
+
+# ``shap``, ``xgboost``, ``scipy``, ``statsmodels`` and ``tsfresh`` take seconds to import,
+# so they are imported inside the functions that use them
 
 
 def stats_select_features(relevance_table):
@@ -53,6 +53,8 @@ def get_fitted_models(
     :param n_jobs: int: number of cores for parallel learning
     :return: List[xgboost.sklearn.XGBRegressor]: list fitted ``XGBRegressor`` models
     """
+    from xgboost import XGBRegressor
+
     models = []
     n_models = len(train_list)
     for i in range(n_models):
@@ -115,6 +117,8 @@ def get_importance(
                 importance_dict[k] += importance_ti[k] / s
 
     if mode == 'shap' or mode == 'all':
+        import shap
+
         for i, model in enumerate(models):
             train_x, train_y = train_list[i].drop(['target'],
                                                   axis=1), train_list[i].loc[:, 'target']
@@ -156,24 +160,232 @@ def importance_select_features(importance_dict,
 
 def get_stats(
         blocks,
-        n_jobs=1
+        n_jobs=1,
+        mode='exact',
+        sample_size=None,
+        confidence=2.0,
+        random_state=0,
 ):
     """
     Using statistical criteria, calculates the significance of the features
     for each block in the list. Then the obtained ``p_value`` s are averaged.
 
+    Depending on the ``mode``, the significance is calculated either by the exact
+    tests from ``tsfresh`` on all rows (default mode) or by ``fast_relevance_table``
+    (fast mode), which tests exactly only the features with a doubtful decision.
+
     :param blocks: List[pd.DataFrame]: list of datas with ``target`` column and the same scheme
     :param n_jobs: int: the number of cores that can be used in the calculation of stat values
+    :param mode: str: ``'exact'`` or ``'fast'``
+    :param sample_size: Optional[int]: the number of rows sampled in fast mode, all the rows are used if None
+    :param confidence: float: the width of the doubtful zone in fast mode (in standard errors)
+    :param random_state: int: seed of the rows sampling in fast mode
     :return: pd.DataFrame: df with calculated ``p_value`` for each of the attributes
     """
+    assert mode == 'exact' or mode == 'fast', \
+        f'mode must be "exact" or "fast", not {mode}!'
 
-    x = pd.DataFrame()
-    for t in blocks:
-        x = pd.concat([x, t.drop(['target'], axis=1)], axis=0)
+    if mode == 'fast':
+        return fast_relevance_table(blocks,
+                                    n_jobs=n_jobs,
+                                    sample_size=sample_size,
+                                    confidence=confidence,
+                                    random_state=random_state)
 
-    y = pd.Series()
-    for t in blocks:
-        y = pd.concat([y, t['target']], axis=0)
+    from tsfresh.feature_selection.relevance import calculate_relevance_table
+
+    x = pd.concat([t.drop(['target'], axis=1) for t in blocks], axis=0)
+    y = pd.concat([t['target'] for t in blocks], axis=0)
 
     relevance_table = calculate_relevance_table(X=x, y=y, n_jobs=n_jobs)
     return relevance_table
+
+
+def fast_relevance_table(
+        blocks,
+        n_jobs=1,
+        sample_size=None,
+        confidence=2.0,
+        random_state=0,
+        chunk_size=500,
+):
+    """
+    Approximate version of ``calculate_relevance_table`` for very wide feature sets:
+
+    - the Spearman rank correlation of each feature with the target is calculated (optionally on a
+      uniform sample of ``sample_size`` rows), it is converted to the ``p_value`` of the test on all the rows
+
+    - the features are ranked by these ``p_value`` s with the same Benjamini-Yekutieli procedure
+      as in ``tsfresh``, this gives the critical correlation of a relevant feature
+
+    - the features whose correlation differs from the critical one by less than ``confidence``
+      standard errors (and features that are constant on the sample) are tested exactly on
+      all the rows by ``calculate_relevance_table``
+
+    - the final decision is made by the Benjamini-Yekutieli procedure over all ``p_value`` s
+
+    The standard error includes the error of sampling and the difference between the Spearman test and
+    the tests from ``tsfresh`` (it is taken equal to the standard error of the correlation on all the rows).
+    The rank correlation is calculated by chunks of ``chunk_size`` features, so the whole table is
+    never concatenated, only the features tested exactly are.
+
+    **Note**
+
+    - for the features that are not tested exactly, ``p_value`` is the one of the Spearman test
+      rather than of the Kendall (real feature) or Mann-Whitney (binary feature) tests from ``tsfresh``;
+
+    - sampling makes the doubtful zone wider, so the sample should not be much smaller than
+      a quarter of the rows, otherwise almost all the features are tested exactly;
+
+    - use ``relevance_agreement`` to compare the result with the exact relevance table.
+
+    :param blocks: List[pd.DataFrame]: list of datas with ``target`` column and the same scheme
+    :param n_jobs: int: the number of cores that can be used in the calculation of exact stat values
+    :param sample_size: Optional[int]: the number of sampled rows, all the rows are used if None
+    :param confidence: float: the width of the doubtful zone (in standard errors)
+    :param random_state: int: seed of the rows sampling
+    :param chunk_size: int: the number of features processed at once
+    :return: pd.DataFrame: df with calculated ``p_value`` for each of the attributes and with ``exact`` column,
+     which marks the features tested exactly
+    """
+    from scipy import stats
+    from statsmodels.stats.multitest import multipletests
+    from tsfresh import defaults
+    from tsfresh.feature_selection.relevance import calculate_relevance_table
+
+    features = blocks[0].columns.drop('target')
+    sizes = [t.shape[0] for t in blocks]
+    n = sum(sizes)
+
+    if sample_size is None or sample_size >= n:
+        block_rows = [slice(None)] * len(blocks)
+        m = n
+    else:
+        rng = np.random.default_rng(random_state)
+        sample = np.sort(rng.choice(n, size=sample_size, replace=False))
+        bounds = np.cumsum([0] + sizes)
+        # positions of the sampled rows inside each block
+        block_rows = [sample[(sample >= lo) & (sample < hi)] - lo for lo, hi in zip(bounds[:-1], bounds[1:])]
+        m = sample_size
+    assert m > 3, f'too small sample: {m} rows'
+
+    def take(columns):
+        values = [t[columns].to_numpy(dtype=np.float64) for t in blocks]
+        # missing values get arbitrary ranks, so they are rejected (on all the rows, not only
+        # on the sampled ones) as in the tests from ``tsfresh``
+        missing = np.any([np.isnan(v).any(axis=0) for v in values], axis=0)
+        if np.any(missing):
+            if isinstance(columns, str):
+                raise ValueError('Target contains NaN values')
+            raise ValueError('Feature {} contains NaN values'.format(columns[missing][0]))
+        return np.concatenate([v[rows] for v, rows in zip(values, block_rows)], axis=0)
+
+    y_rank = stats.rankdata(take('target'))
+    y_rank = (y_rank - y_rank.mean()) / np.linalg.norm(y_rank - y_rank.mean())
+
+    rho = np.empty(len(features))
+    n_unique = np.empty(len(features), dtype=np.int64)
+    for start in range(0, len(features), chunk_size):
+        columns = features[start:start + chunk_size]
+        rho[start:start + len(columns)], n_unique[start:start + len(columns)] = \
+            _rank_correlation(np.ascontiguousarray(take(columns).T), y_rank)
+
+    rho = np.clip(np.nan_to_num(rho), -1 + 1e-12, 1 - 1e-12)
+    p_value = 2 * stats.t.sf(np.abs(rho) * np.sqrt((n - 2) / (1 - rho ** 2)), n - 2)
+
+    method = 'fdr_bh' if defaults.HYPOTHESES_INDEPENDENT else 'fdr_by'
+    relevant = multipletests(p_value, defaults.FDR_LEVEL, method)[0]
+    if relevant.any():
+        critical_p_value = p_value[relevant].max()
+    else:
+        # the threshold of the first step of the procedure
+        critical_p_value = defaults.FDR_LEVEL / len(features)
+        if method == 'fdr_by':
+            critical_p_value /= np.sum(1 / np.arange(1, len(features) + 1))
+
+    critical_t = stats.t.isf(critical_p_value / 2, n - 2)
+    critical_rho = critical_t / np.sqrt(n - 2 + critical_t ** 2)
+    # standard errors of the Fisher transformation of the Spearman correlation: sampling
+    # (with finite population correction) and difference between the tests on all the rows
+    std = np.sqrt(1.06 * (1 / (m - 3) - 1 / (n - 3)) + 1 / (n - 3))
+    doubtful = np.abs(np.abs(np.arctanh(rho)) - np.arctanh(critical_rho)) < confidence * std
+    exact = doubtful | (n_unique <= 1)
+
+    relevance_table = pd.DataFrame(index=pd.Series(features, name='feature'))
+    relevance_table['feature'] = relevance_table.index
+    relevance_table['type'] = np.where(n_unique == 2, 'binary', 'real')
+    relevance_table['p_value'] = p_value
+    relevance_table['exact'] = exact
+
+    exact_features = features[exact]
+    if len(exact_features) > 0:
+        x = pd.concat([t[exact_features] for t in blocks], axis=0)
+        y = pd.concat([t['target'] for t in blocks], axis=0)
+        exact_table = calculate_relevance_table(X=x, y=y, n_jobs=n_jobs)
+        relevance_table.loc[exact_table.index, 'type'] = exact_table['type']
+        # constant features have no ``p_value``, so the column is of object dtype if there are no binary ones
+        relevance_table.loc[exact_table.index, 'p_value'] = pd.to_numeric(exact_table['p_value'], errors='coerce')
+
+    tested = relevance_table['p_value'].notna()
+    relevance_table['relevant'] = False
+    if tested.any():
+        relevance_table.loc[tested, 'relevant'] = multipletests(
+            relevance_table.loc[tested, 'p_value'], defaults.FDR_LEVEL, method)[0]
+
+    return relevance_table.sort_values('p_value')
+
+
+def _rank_correlation(x, y_rank):
+    """
+    Spearman correlation of each row of ``x`` with the target (ties get average ranks).
+    The ranks of ``x`` are not scattered back, the target ranks are gathered in the sorted
+    order instead.
+
+    :param x: np.ndarray: matrix of feature values, one feature per row
+    :param y_rank: np.ndarray: centered and normalized ranks of the target
+    :return: Tuple[np.ndarray, np.ndarray]: correlations and the numbers of unique values of the features
+    """
+    n = x.shape[1]
+    order = np.argsort(x, axis=1)
+    x_sorted = np.take_along_axis(x, order, axis=1)
+
+    # a group of tied values starts at ``new`` and ends before the next one
+    new = np.empty(x.shape, dtype=bool)
+    new[:, 0] = True
+    np.not_equal(x_sorted[:, 1:], x_sorted[:, :-1], out=new[:, 1:])
+    pos = np.arange(n)
+    first = np.maximum.accumulate(np.where(new, pos, 0), axis=1)
+    last = np.empty(x.shape, dtype=np.int64)
+    last[:, -1] = n - 1
+    last[:, :-1] = np.where(new[:, 1:], pos[:-1], n)
+    last = np.minimum.accumulate(last[:, ::-1], axis=1)[:, ::-1]
+
+    # average ranks of the sorted values minus their mean (n + 1) / 2
+    x_rank = (first + last - (n - 1)) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = (x_rank * y_rank[order]).sum(axis=1) / np.linalg.norm(x_rank, axis=1)
+    return rho, new.sum(axis=1)
+
+
+def relevance_agreement(exact_table, fast_table):
+    """
+    Compares the approximate relevance table with the exact one.
+
+    :param exact_table: pd.DataFrame: relevance table from ``get_stats`` in exact mode
+    :param fast_table: pd.DataFrame: relevance table from ``get_stats`` in fast mode
+    :return: Dict[str, float]: the share of features with the same decision (``agreement``), the shares of
+     the exact relevant features found by the fast mode (``recall``) and of the fast relevant features
+     which are relevant (``precision``), Spearman correlation of ``p_value`` s (``p_value_corr``) and the share
+     of features tested exactly in the fast mode (``exact_share``)
+    """
+    fast_table = fast_table.loc[exact_table.index]
+    exact_relevant = exact_table['relevant'].astype(bool)
+    fast_relevant = fast_table['relevant'].astype(bool)
+    both = (exact_relevant & fast_relevant).sum()
+    return {
+        'agreement': (exact_relevant == fast_relevant).mean(),
+        'recall': both / max(exact_relevant.sum(), 1),
+        'precision': both / max(fast_relevant.sum(), 1),
+        'p_value_corr': exact_table['p_value'].corr(fast_table['p_value'], method='spearman'),
+        'exact_share': fast_table['exact'].mean(),
+    }
@@ -0,0 +1,246 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from typing import List, Optional
+
+
+class SeriesStore:
+    """
+    Append-only, memory-mapped storage of a quantized table.
+
+    The store is a directory with the following files:
+
+    - ``meta.json``: the names and dtypes of the value columns, the dtype of ``event_time``
+      and the numbers of committed rows
+
+    - ``index.bin``: ``event_time`` of each row (int64, nanoseconds)
+
+    - ``values.bin``: row-major matrix of the table values (float64)
+
+    - ``valid.bin``: precomputed positions of the rows without missing values (int64)
+
+    New rows are appended to the end of each file, so adding fresh ``300ms`` bars
+    does not rewrite the data that is already on disk. All the files are read
+    through ``np.memmap``, thus slicing by position does not copy anything and
+    does not load the whole table into memory.
+
+    The numbers of rows in ``meta.json`` are replaced atomically after the data is written,
+    and only the committed rows are read. If the process dies during ``append``, the store
+    stays consistent: the partially written rows are ignored and cut off by the next ``append``.
+
+    **Note**
+
+    - only numeric columns can be stored, they are kept as ``float64`` and converted back to
+      their original dtypes by ``frame`` (integer columns must not contain missing values);
+
+    - ``event_time`` is converted back to its original ``datetime64`` dtype (its unit and time zone),
+      ``event_time`` of other dtypes (e.g. strings read from csv) is returned as ``datetime64[ns]``;
+
+    - ``event_time`` must be strictly increasing across all appended tables.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the existing store.
+
+        :param path: str: the directory of the store
+        """
+        with open(f'{path}/meta.json') as f:
+            meta = json.load(f)
+        self.path = path
+        self.columns = meta['columns']
+        self.dtypes = meta['dtypes']
+        self.event_time_dtype = meta.get('event_time_dtype', 'datetime64[ns]')
+        self._n_rows = meta['n_rows']
+        self._n_valid = meta['n_valid']
+        self._map()
+
+    @classmethod
+    def create(cls, df, path):
+        """
+        Creates a new store at ``path`` and fills it with the rows of ``df``.
+
+        :param df: pd.DataFrame: quantized table, ``event_time`` is either its index or one of its columns
+        :param path: str: the directory where the store will be created
+        :return: SeriesStore: the opened store
+        """
+        os.makedirs(path, exist_ok=True)
+        if 'event_time' not in df.columns:
+            df = df.reset_index()
+        columns = [c for c in df.columns if c != 'event_time']
+        dtypes = {c: str(df[c].dtype) for c in columns}
+        event_time_dtype = df['event_time'].dtype
+        event_time_dtype = str(event_time_dtype) if event_time_dtype.kind == 'M' else 'datetime64[ns]'
+        for name in ['index', 'values', 'valid']:
+            open(f'{path}/{name}.bin', 'wb').close()
+        _write_meta(path, {'columns': columns, 'dtypes': dtypes, 'event_time_dtype': event_time_dtype,
+                           'n_rows': 0, 'n_valid': 0})
+
+        store = cls(path)
+        store.append(df)
+        return store
+
+    def append(self, df):
+        """
+        Appends the rows of ``df`` to the end of the store without rewriting it.
+
+        :param df: pd.DataFrame: new rows with the same columns as the store
+        """
+        if 'event_time' not in df.columns:
+            df = df.reset_index()
+        event_time = pd.to_datetime(df['event_time']).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        values = np.ascontiguousarray(df[self.columns].to_numpy(dtype=np.float64))
+
+        if event_time.shape[0] == 0:
+            return
+        assert np.all(np.diff(event_time) > 0), 'event_time of the new rows must be strictly increasing'
+        assert len(self) == 0 or event_time[0] > self._index[-1], \
+            f'the new rows must follow the last row of the store ({self.last_event_time})'
+
+        valid = len(self) + np.flatnonzero(~np.isnan(values).any(axis=1))
+
+        committed = [('index', self._n_rows), ('values', self._n_rows * len(self.columns)), ('valid', self._n_valid)]
+        new_data = [event_time, values, valid.astype(np.int64)]
+        for (name, size), array in zip(committed, new_data):
+            with open(f'{self.path}/{name}.bin', 'r+b') as f:
+                # cut off the rows left by an interrupted append
+                f.truncate(size * 8)
+                f.seek(0, os.SEEK_END)
+                f.write(array.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        self._n_rows += event_time.shape[0]
+        self._n_valid += valid.shape[0]
+        _write_meta(self.path, {'columns': self.columns, 'dtypes': self.dtypes,
+                                'event_time_dtype': self.event_time_dtype,
+                                'n_rows': self._n_rows, 'n_valid': self._n_valid})
+        self._map()
+
+    def _map(self):
+        """ (re)opens the memory maps of the committed rows """
+        self._index = _memmap(f'{self.path}/index.bin', np.int64, (self._n_rows,))
+        self._values = _memmap(f'{self.path}/values.bin', np.float64, (self._n_rows, len(self.columns)))
+        self._valid = _memmap(f'{self.path}/valid.bin', np.int64, (self._n_valid,))
+        assert self._n_valid == 0 or self._valid[-1] < self._n_rows, \
+            f'the store {self.path} is corrupted: a valid row is out of the table'
+
+    def __len__(self):
+        return self._index.shape[0]
+
+    @property
+    def n_valid(self):
+        """ the number of rows without missing values """
+        return self._valid.shape[0]
+
+    @property
+    def last_event_time(self):
+        """ ``event_time`` of the last row of the store """
+        return self._event_time(self._index[-1:])[0]
+
+    def rows(self, start=None, stop=None):
+        """
+        Returns the values of the rows ``[start, stop)`` of the store (without copying).
+
+        :param start: Optional[int]: the first position
+        :param stop: Optional[int]: the position after the last one
+        :return: np.ndarray: matrix of values, its columns are ``self.columns``
+        """
+        return self._values[start:stop]
+
+    def column(self, name):
+        """
+        Returns all the values of the column ``name`` (without copying).
+
+        :param name: str: column name
+        :return: np.ndarray: column values
+        """
+        return self._values[:, self.columns.index(name)]
+
+    def valid_positions(self, start=None, stop=None):
+        """
+        Returns the positions of the rows without missing values, from the ``start``-th
+        valid row to the ``stop``-th one (without copying).
+
+        :param start: Optional[int]: the first valid row
+        :param stop: Optional[int]: the valid row after the last one
+        :return: np.ndarray: positions of the rows in the store
+        """
+        return self._valid[start:stop]
+
+    def frame(self, positions):
+        """
+        Builds a table from the rows of the store with the given positions. Only the
+        requested rows are read from disk.
+
+        :param positions: np.ndarray: positions of the rows in the store
+        :return: pd.DataFrame: table with ``event_time`` column and the columns of the store
+        """
+        df = pd.DataFrame(self._values[positions], columns=self.columns).astype(self.dtypes)
+        df.insert(0, 'event_time', self._event_time(self._index[positions]))
+        return df
+
+    def _event_time(self, index):
+        """ converts the stored nanoseconds to ``event_time`` of the original dtype """
+        event_time = pd.Series(index.astype('datetime64[ns]'))
+        if isinstance(pd.api.types.pandas_dtype(self.event_time_dtype), pd.DatetimeTZDtype):
+            event_time = event_time.dt.tz_localize('UTC')
+        return event_time.astype(self.event_time_dtype)
+
+
+def _memmap(path, dtype, shape):
+    """ read-only memory map of the beginning of the file (``np.memmap`` can not map an empty file) """
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    assert os.path.getsize(path) >= size, f'{path} is shorter than the committed number of rows'
+    if size == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+def _write_meta(path, meta):
+    """ atomically replaces ``meta.json`` of the store """
+    with open(f'{path}/meta.json.tmp', 'w') as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{path}/meta.json.tmp', f'{path}/meta.json')
+
+
+def save_stores(df_dict,
+                names,
+                path_to):
+    """
+    Saves tables from ``df_dict`` dictionary with keys from ``names`` list as ``SeriesStore`` s.
+    If the store already exists, only the rows after its last ``event_time`` are appended.
+
+    :param df_dict: Dict[str, pd.DataFrame]: dictionary with quantized tables
+    :param names: List[str]: a subset of the ``df_dict`` keys for which the tables are to be saved
+    :param path_to: str: the address where we want to save the stores
+    """
+    for name in names:
+        path = f'{path_to}/{name}'
+        if not os.path.exists(f'{path}/meta.json'):
+            SeriesStore.create(df_dict[name], path)
+            continue
+
+        store = SeriesStore(path)
+        df = df_dict[name]
+        if 'event_time' not in df.columns:
+            df = df.reset_index()
+        if len(store) > 0:
+            df = df[pd.to_datetime(df['event_time']) > store.last_event_time]
+        store.append(df)
+
+
+def load_stores(names,
+                path_from):
+    """
+    Opens stores from ``path_from`` address with names from the list ``names`` into the dictionary.
+
+    :param names: List[str]: store names
+    :param path_from: str: path to the stores
+    :return: Dict[str, SeriesStore]: dictionary, its keys are ``names`` list items, values are opened
+     stores from ``path_from/name``
+    """
+    return {name: SeriesStore(f'{path_from}/{name}') for name in names}